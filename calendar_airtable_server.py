@@ -1,101 +1,336 @@
 import asyncio
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any
 import json
 import aiohttp
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+def airtable_string(value: str) -> str:
+    """Quote a value as an Airtable formula string literal"""
+    escaped = value.replace('\\', '\\\\').replace("'", "\\'")
+    return f"'{escaped}'"
+
+def _json_dumps(obj) -> str:
+    """orjson encoder for aiohttp, which expects a str"""
+    return orjson.dumps(obj).decode()
+
+ISO_FMT = '%Y-%m-%dT%H:%M:%SZ'
+
+GOOGLE_EVENTS_URL = 'https://www.googleapis.com/calendar/v3/calendars/primary/events'
+GOOGLE_FREEBUSY_URL = 'https://www.googleapis.com/calendar/v3/freeBusy'
+
+# Upstream responses worth retrying, and how hard to try. A 5xx can arrive after
+# the write happened, so creates only retry when they were rate limited.
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+CREATE_RETRY_STATUSES = frozenset({429})
+MAX_RETRIES = 3
+# Longest single wait a handler will sit through; a longer Retry-After gives up
+MAX_RETRY_WAIT = 4
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=5)
+
+# Airtable accepts at most this many records per create request
+AIRTABLE_BATCH_SIZE = 10
+# and returns at most this many per list page
+AIRTABLE_PAGE_SIZE = 100
+
+class AsyncTTLCache:
+    """Short-lived cache for upstream reads that coalesces concurrent misses"""
+    
+    def __init__(self, maxsize: int = 128, ttl: float = 60):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+    
+    async def get_or_load(self, key: tuple, loader):
+        """Return the cached value for key, awaiting loader() once on a miss
+        
+        Concurrent callers for the same key share one load and its outcome,
+        including a None result or an exception.
+        """
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+        
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, loader))
+            self._inflight[key] = task
+        # Shield so one cancelled caller does not cancel the shared load
+        return await asyncio.shield(task)
+    
+    async def _load(self, key: tuple, loader):
+        task = asyncio.current_task()
+        try:
+            value = await loader()
+            # Failed fetches come back as None and are not cached; a load that
+            # was invalidated while in flight may be stale, so skip it too
+            if value is not None and self._inflight.get(key) is task:
+                self._cache[key] = value
+            return value
+        finally:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+    
+    def invalidate(self, *prefix):
+        """Drop every entry whose key starts with prefix"""
+        for key in [k for k in list(self._cache) if k[:len(prefix)] == prefix]:
+            self._cache.pop(key, None)
+        for key in [k for k in self._inflight if k[:len(prefix)] == prefix]:
+            del self._inflight[key]
+
 class CalendarAirtableServer:
     def __init__(self):
         self.google_calendar_token = os.getenv('GOOGLE_CALENDAR_TOKEN')
         self.airtable_api_key = os.getenv('AIRTABLE_API_KEY')
         self.airtable_base_id = os.getenv('AIRTABLE_BASE_ID')
-        
-    async def get_google_events(self, start_time: str = None, end_time: str = None):
-        """Fetch events from Google Calendar"""
-        headers = {
+        self._google_headers = {
             'Authorization': f'Bearer {self.google_calendar_token}',
             'Content-Type': 'application/json'
         }
+        self._airtable_headers = {
+            'Authorization': f'Bearer {self.airtable_api_key}',
+            'Content-Type': 'application/json'
+        }
+        self._airtable_base_url = f'https://api.airtable.com/v0/{self.airtable_base_id}'
+        self._session: aiohttp.ClientSession | None = None
+        self._cache = AsyncTTLCache(maxsize=128, ttl=60)
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=20,
+                    ttl_dns_cache=300,
+                    enable_cleanup_closed=True
+                ),
+                timeout=REQUEST_TIMEOUT,
+                json_serialize=_json_dumps
+            )
+        return self._session
+    
+    async def close(self):
+        """Close the shared HTTP session"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _request(self, method: str, url: str,
+                       retry_statuses: frozenset = RETRY_STATUSES,
+                       raise_on_error: bool = False, **kw):
+        """Send a request, retrying the given statuses with bounded backoff
+        
+        Returns the decoded JSON body on 200, or None once retries run out or
+        the upstream asks for a longer wait than MAX_RETRY_WAIT (or raises
+        aiohttp.ClientResponseError when raise_on_error is set).
+        """
+        session = await self._get_session()
+        for attempt in range(MAX_RETRIES + 1):
+            async with session.request(method, url, **kw) as response:
+                if response.status == 200:
+                    return orjson.loads(await response.read())
+                retry_after = response.headers.get('Retry-After', '0')
+                retry_after = int(retry_after) if retry_after.isdigit() else 0
+                delay = retry_after or 2 ** attempt
+                if (response.status not in retry_statuses
+                        or attempt == MAX_RETRIES
+                        or delay > MAX_RETRY_WAIT):
+                    if raise_on_error:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info,
+                            response.history,
+                            status=response.status,
+                            message=response.reason or '',
+                            headers=response.headers
+                        )
+                    return None
+            # Honour a short Retry-After, otherwise back off exponentially
+            await asyncio.sleep(delay)
+    
+    def invalidate(self, table_name: str = None):
+        """Evict cached Airtable reads for a table, or everything when no table is given"""
+        if table_name is None:
+            self._cache.invalidate()
+        else:
+            self._cache.invalidate('airtable', table_name)
+        
+    async def get_google_events(self, start_time: str = None, end_time: str = None,
+                                fields: str = None):
+        """Fetch events from Google Calendar
+        
+        Raises aiohttp.ClientResponseError if the upstream request fails.
+        """
+        if start_time is None or end_time is None:
+            # Round to the minute so default windows share a cache entry
+            now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+            start_time = start_time or now.strftime(ISO_FMT)
+            end_time = end_time or (now + timedelta(days=7)).strftime(ISO_FMT)
         
         params = {
-            'timeMin': start_time or datetime.utcnow().isoformat() + 'Z',
-            'timeMax': end_time or (datetime.utcnow() + timedelta(days=7)).isoformat() + 'Z',
+            'timeMin': start_time,
+            'timeMax': end_time,
             'singleEvents': 'true',
             'orderBy': 'startTime'
         }
+        if fields:
+            # Partial response, e.g. 'items(summary,start,end)'
+            params['fields'] = fields
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                'https://www.googleapis.com/calendar/v3/calendars/primary/events',
-                headers=headers,
-                params=params
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get('items', [])
-                return []
+        async def fetch():
+            data = await self._request(
+                'GET',
+                GOOGLE_EVENTS_URL,
+                headers=self._google_headers,
+                params=params,
+                raise_on_error=True
+            )
+            return data.get('items', [])
+        
+        return await self._cache.get_or_load(('google', start_time, end_time, fields), fetch)
     
-    async def create_google_event(self, event_data: Dict[str, Any]):
-        """Create a new Google Calendar event"""
-        headers = {
-            'Authorization': f'Bearer {self.google_calendar_token}',
-            'Content-Type': 'application/json'
+    async def query_freebusy(self, time_min: str, time_max: str):
+        """Fetch busy intervals on the primary calendar
+        
+        Raises aiohttp.ClientResponseError if the upstream request fails.
+        """
+        payload = {
+            'timeMin': time_min,
+            'timeMax': time_max,
+            'items': [{'id': 'primary'}]
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                'https://www.googleapis.com/calendar/v3/calendars/primary/events',
-                headers=headers,
-                json=event_data
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                return None
+        async def fetch():
+            # freeBusy is a read despite the POST, so it keeps the full retry set
+            data = await self._request(
+                'POST',
+                GOOGLE_FREEBUSY_URL,
+                headers=self._google_headers,
+                json=payload,
+                raise_on_error=True
+            )
+            return data.get('calendars', {}).get('primary', {}).get('busy', [])
+        
+        return await self._cache.get_or_load(('google', 'freebusy', time_min, time_max), fetch)
     
-    async def get_airtable_records(self, table_name: str, filter_formula: str = None):
-        """Fetch records from Airtable"""
-        headers = {
-            'Authorization': f'Bearer {self.airtable_api_key}',
-            'Content-Type': 'application/json'
-        }
+    async def create_google_event(self, event_data: Dict[str, Any]):
+        """Create a new Google Calendar event"""
+        result = await self._request(
+            'POST',
+            GOOGLE_EVENTS_URL,
+            headers=self._google_headers,
+            json=event_data,
+            retry_statuses=CREATE_RETRY_STATUSES
+        )
+        if result is not None:
+            self._cache.invalidate('google')
+        return result
+    
+    async def get_airtable_records(self, table_name: str, filter_formula: str = None,
+                                   max_records: int = None, page_size: int = None):
+        """Fetch records from Airtable
         
+        Raises aiohttp.ClientResponseError if the upstream request fails, the
+        same as iter_airtable_records.
+        """
         params = {}
         if filter_formula:
             params['filterByFormula'] = filter_formula
+        if max_records:
+            params['maxRecords'] = str(max_records)
+        if page_size:
+            params['pageSize'] = str(page_size)
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f'https://api.airtable.com/v0/{self.airtable_base_id}/{table_name}',
-                headers=headers,
-                params=params
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get('records', [])
-                return []
+        async def fetch():
+            data = await self._request(
+                'GET',
+                f'{self._airtable_base_url}/{table_name}',
+                headers=self._airtable_headers,
+                params=params,
+                raise_on_error=True
+            )
+            return data.get('records', [])
+        
+        key = ('airtable', table_name, filter_formula, max_records, page_size)
+        return await self._cache.get_or_load(key, fetch)
+    
+    async def iter_airtable_records(self, table_name: str, filter_formula: str = None):
+        """Yield every record in an Airtable table, one page at a time
+        
+        Raises aiohttp.ClientResponseError if any page fails, so a partial
+        listing is never mistaken for the whole table.
+        """
+        params = {'pageSize': str(AIRTABLE_PAGE_SIZE)}
+        if filter_formula:
+            params['filterByFormula'] = filter_formula
+        
+        while True:
+            data = await self._request(
+                'GET',
+                f'{self._airtable_base_url}/{table_name}',
+                headers=self._airtable_headers,
+                params=params,
+                raise_on_error=True
+            )
+            for record in data.get('records', []):
+                yield record
+            offset = data.get('offset')
+            if not offset:
+                return
+            params['offset'] = offset
     
     async def create_airtable_record(self, table_name: str, fields: Dict[str, Any]):
         """Create a new Airtable record"""
-        headers = {
-            'Authorization': f'Bearer {self.airtable_api_key}',
-            'Content-Type': 'application/json'
-        }
-        
         payload = {
-            'fields': fields
+            'fields': fields,
+            'typecast': True
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f'https://api.airtable.com/v0/{self.airtable_base_id}/{table_name}',
-                headers=headers,
-                json=payload
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                return None
+        result = await self._request(
+            'POST',
+            f'{self._airtable_base_url}/{table_name}',
+            headers=self._airtable_headers,
+            json=payload,
+            retry_statuses=CREATE_RETRY_STATUSES
+        )
+        if result is not None:
+            self.invalidate(table_name)
+        return result
+    
+    async def create_airtable_records(self, table_name: str, list_of_fields: List[Dict[str, Any]]):
+        """Create several Airtable records, up to 10 per request
+        
+        Returns the created records and the input indices that were not created.
+        """
+        if len(list_of_fields) == 1:
+            result = await self.create_airtable_record(table_name, list_of_fields[0])
+            return ([result], []) if result else ([], [0])
+        
+        created = []
+        failed = []
+        for i in range(0, len(list_of_fields), AIRTABLE_BATCH_SIZE):
+            chunk = list_of_fields[i:i + AIRTABLE_BATCH_SIZE]
+            payload = {
+                'records': [{'fields': fields} for fields in chunk],
+                'typecast': True
+            }
+            data = await self._request(
+                'POST',
+                f'{self._airtable_base_url}/{table_name}',
+                headers=self._airtable_headers,
+                json=payload,
+                retry_statuses=CREATE_RETRY_STATUSES
+            )
+            if data is not None:
+                created.extend(data.get('records', []))
+            else:
+                failed.extend(range(i, i + len(chunk)))
+        
+        if created:
+            self.invalidate(table_name)
+        return created, failed
@@ -0,0 +1,140 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from calendar_airtable_server import AsyncTTLCache, CalendarAirtableServer
+
+
+async def _with_upstream(handler, body):
+    """Run body(service) against a local fake Airtable serving handler"""
+    app = web.Application()
+    app.router.add_route('*', '/{path:.*}', handler)
+    server = TestServer(app)
+    await server.start_server()
+    service = CalendarAirtableServer()
+    service._airtable_base_url = str(server.make_url('/v0/base'))
+    try:
+        return await body(service)
+    finally:
+        await service.close()
+        await server.close()
+
+
+def _responses(*responses):
+    """Handler that replays responses in order and records each request"""
+    seen = []
+
+    async def handler(request):
+        seen.append((request.method, dict(request.query)))
+        status, payload, headers = responses[min(len(seen), len(responses)) - 1]
+        if payload is None:
+            return web.Response(status=status, headers=headers)
+        return web.json_response(payload, status=status, headers=headers)
+
+    return handler, seen
+
+
+def test_concurrent_misses_share_one_load():
+    cache = AsyncTTLCache()
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return ['record']
+
+    async def main():
+        return await asyncio.gather(*[cache.get_or_load(('airtable', 'Tasks'), loader) for _ in range(5)])
+
+    assert asyncio.run(main()) == [['record']] * 5
+    assert calls == 1
+
+
+def test_concurrent_misses_share_a_failed_load():
+    cache = AsyncTTLCache()
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise aiohttp.ClientError('upstream down')
+
+    async def main():
+        return await asyncio.gather(
+            *[cache.get_or_load(('airtable', 'Tasks'), loader) for _ in range(3)],
+            return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+    assert calls == 1
+    assert all(isinstance(result, aiohttp.ClientError) for result in results)
+
+
+def test_invalidate_during_load_does_not_cache_stale_value():
+    cache = AsyncTTLCache()
+    key = ('airtable', 'Tasks')
+
+    async def stale():
+        await asyncio.sleep(0.01)
+        return ['stale']
+
+    async def fresh():
+        return ['fresh']
+
+    async def main():
+        pending = asyncio.ensure_future(cache.get_or_load(key, stale))
+        await asyncio.sleep(0)
+        cache.invalidate('airtable', 'Tasks')
+        assert await pending == ['stale']
+        return await cache.get_or_load(key, fresh)
+
+    assert asyncio.run(main()) == ['fresh']
+
+
+def test_reads_retry_server_errors():
+    handler, seen = _responses((503, None, {}), (200, {'records': [{'id': 'a'}]}, {}))
+    records = asyncio.run(_with_upstream(handler, lambda service: service.get_airtable_records('Tasks')))
+    assert records == [{'id': 'a'}]
+    assert len(seen) == 2
+
+
+def test_creates_do_not_retry_server_errors():
+    handler, seen = _responses((503, None, {}), (200, {'id': 'a'}, {}))
+    result = asyncio.run(_with_upstream(handler, lambda service: service.create_airtable_record('Tasks', {'Name': 'x'})))
+    assert result is None
+    assert seen == [('POST', {})]
+
+
+def test_creates_retry_rate_limits():
+    handler, seen = _responses((429, None, {'Retry-After': '1'}), (200, {'id': 'a'}, {}))
+    result = asyncio.run(_with_upstream(handler, lambda service: service.create_airtable_record('Tasks', {'Name': 'x'})))
+    assert result == {'id': 'a'}
+    assert len(seen) == 2
+
+
+def test_long_retry_after_gives_up_without_waiting():
+    handler, seen = _responses((429, None, {'Retry-After': '3600'}), (200, {'records': []}, {}))
+    with pytest.raises(aiohttp.ClientResponseError) as excinfo:
+        asyncio.run(_with_upstream(handler, lambda service: service.get_airtable_records('Tasks')))
+    assert excinfo.value.status == 429
+    assert len(seen) == 1
+
+
+def test_iter_airtable_records_raises_on_later_page_failure():
+    handler, seen = _responses((200, {'records': [{'id': 'a'}], 'offset': 'page2'}, {}), (404, None, {}))
+    received = []
+
+    async def body(service):
+        async for record in service.iter_airtable_records('Tasks'):
+            received.append(record)
+
+    with pytest.raises(aiohttp.ClientResponseError) as excinfo:
+        asyncio.run(_with_upstream(handler, body))
+    assert excinfo.value.status == 404
+    assert received == [{'id': 'a'}]
+    assert seen[1][1]['offset'] == 'page2'
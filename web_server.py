@@ -1,17 +1,122 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import asyncio
 import json
+import logging
 import os
-from typing import Dict, Any
+import orjson
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+from typing import Annotated, Dict, Any, List
+from pydantic import BaseModel, Field, field_validator
+import aiohttp
 import uvicorn
-from calendar_airtable_server import CalendarAirtableServer
+from calendar_airtable_server import CalendarAirtableServer, airtable_string, ISO_FMT
 
-app = FastAPI(title="Calendar & Airtable MCP Server")
+logger = logging.getLogger(__name__)
+
+class OrjsonResponse(JSONResponse):
+    """JSON response rendered with orjson"""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await calendar_service.close()
+
+app = FastAPI(
+    title="Calendar & Airtable MCP Server",
+    default_response_class=OrjsonResponse,
+    lifespan=lifespan
+)
+
+# Airtable's maximum page size; one request covers a contact search
+CONTACT_SEARCH_LIMIT = 100
+
+DATE_RE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+TIME_RE = re.compile(r"[0-9]{2}:[0-9]{2}")
+DATETIME_RE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}[Tt ][0-9]{2}:[0-9]{2}", re.ASCII)
+
+_TZ = {"timeZone": "America/New_York"}
+_LOCAL_TZ = ZoneInfo(_TZ["timeZone"])
+
+# A slot longer than a day is not an availability check
+MAX_DURATION_MINUTES = 24 * 60
+
+@lru_cache(maxsize=64)
+def _duration(minutes: int) -> timedelta:
+    return timedelta(minutes=minutes)
+
+class AvailabilityIn(BaseModel):
+    date: str
+    start_time: str
+    duration_minutes: int = Field(60, gt=0, le=MAX_DURATION_MINUTES)
+
+class TaskIn(BaseModel):
+    name: str
+    status: str = "To Do"
+    priority: str = "Medium"
+    due_date: str | None = None
+    notes: str = ""
+
+class ContactSearchIn(BaseModel):
+    search_term: str = ""
+
+class ReminderIn(BaseModel):
+    title: str
+    datetime: datetime
+    notes: str = ""
+    
+    @field_validator("datetime", mode="before")
+    @classmethod
+    def _require_time(cls, value):
+        # Lax mode would read a bare date as midnight
+        if not isinstance(value, str) or not DATETIME_RE.match(value):
+            raise ValueError("datetime must be an ISO 8601 date and time")
+        return value
+
+async def _ndjson(first, records):
+    if first is None:
+        return
+    yield orjson.dumps(first) + b"\n"
+    async for record in records:
+        yield orjson.dumps(record) + b"\n"
+
+# Upstream statuses caused by the caller's request (unknown table, bad
+# formula), which retrying will not fix
+UPSTREAM_CLIENT_ERRORS = {
+    400: (400, "Upstream rejected the request"),
+    404: (404, "Upstream resource not found"),
+    422: (400, "Upstream rejected the request")
+}
 
 # Initialize the service
 calendar_service = CalendarAirtableServer()
 
+@app.exception_handler(asyncio.TimeoutError)
+async def upstream_timeout_handler(request: Request, exc: asyncio.TimeoutError):
+    logger.warning("Upstream request timed out: %r", exc)
+    return OrjsonResponse(status_code=504, content={"detail": "Upstream request timed out"})
+
+@app.exception_handler(aiohttp.ClientError)
+async def upstream_error_handler(request: Request, exc: aiohttp.ClientError):
+    # aiohttp's timeout errors subclass ClientError before TimeoutError, so
+    # Starlette routes them here; they still deserve a 504
+    if isinstance(exc, asyncio.TimeoutError):
+        return await upstream_timeout_handler(request, exc)
+    # The exception text carries the upstream URL (base id, query), so it is
+    # logged here and the client only gets a fixed message
+    logger.warning("Upstream request failed: %s", exc)
+    if isinstance(exc, aiohttp.ClientResponseError) and exc.status in UPSTREAM_CLIENT_ERRORS:
+        status_code, detail = UPSTREAM_CLIENT_ERRORS[exc.status]
+        return OrjsonResponse(status_code=status_code, content={"detail": detail})
+    return OrjsonResponse(status_code=502, content={"detail": "Upstream request failed"})
+
 @app.get("/")
 async def root():
     return {"message": "Calendar & Airtable MCP Server is running"}
@@ -23,172 +128,222 @@ async def health_check():
 @app.post("/calendar/events")
 async def create_calendar_event(event_data: Dict[str, Any]):
     """Create a new calendar event"""
-    try:
-        result = await calendar_service.create_google_event(event_data)
-        if result:
-            return {"success": True, "event": result}
-        else:
-            raise HTTPException(status_code=400, detail="Failed to create event")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    result = await calendar_service.create_google_event(event_data)
+    if result:
+        return {"success": True, "event": result}
+    else:
+        raise HTTPException(status_code=400, detail="Failed to create event")
 
 @app.get("/calendar/events")
 async def get_calendar_events(start_time: str = None, end_time: str = None):
     """Get calendar events"""
-    try:
-        events = await calendar_service.get_google_events(start_time, end_time)
-        return {"events": events}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    events = await calendar_service.get_google_events(start_time, end_time)
+    return {"events": events}
+
+@app.get("/dashboard")
+async def get_dashboard():
+    """Get today's events, tasks and contacts in one call"""
+    # "Today" is the local calendar day the app schedules in, sent to Google as UTC
+    today = datetime.now(_LOCAL_TZ).date()
+    today_start = datetime.combine(today, time(), tzinfo=_LOCAL_TZ)
+    today_end = datetime.combine(today + timedelta(days=1), time(), tzinfo=_LOCAL_TZ)
+    
+    # Three independent reads, fetched concurrently
+    events, tasks, contacts = await asyncio.gather(
+        calendar_service.get_google_events(
+            today_start.astimezone(timezone.utc).strftime(ISO_FMT),
+            today_end.astimezone(timezone.utc).strftime(ISO_FMT)
+        ),
+        calendar_service.get_airtable_records("Tasks"),
+        calendar_service.get_airtable_records("Contacts")
+    )
+    
+    return {"events": events, "tasks": tasks, "contacts": contacts}
 
 @app.post("/calendar/check-availability")
-async def check_availability(data: Dict[str, Any]):
+async def check_availability(data: AvailabilityIn):
     """Check calendar availability"""
+    date = data.date
+    start_time = data.start_time
+    duration = data.duration_minutes
+    
+    if not DATE_RE.fullmatch(date):
+        raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+    if not TIME_RE.fullmatch(start_time):
+        raise HTTPException(status_code=400, detail="start_time must be HH:MM")
+    
     try:
-        from datetime import datetime, timedelta
-        
-        date = data.get("date")
-        start_time = data.get("start_time") 
-        duration = data.get("duration_minutes", 60)
-        
-        # Convert to datetime objects
-        start_datetime = datetime.fromisoformat(f"{date}T{start_time}:00")
-        end_datetime = start_datetime + timedelta(minutes=duration)
-        
-        # Check calendar for conflicts
+        # The slot is wall-clock time in the app's zone
+        start_datetime = datetime.strptime(
+            f"{date} {start_time}", "%Y-%m-%d %H:%M"
+        ).replace(tzinfo=_LOCAL_TZ)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date or start_time")
+    end_datetime = start_datetime + _duration(duration)
+    
+    time_min = start_datetime.astimezone(timezone.utc).strftime(ISO_FMT)
+    time_max = end_datetime.astimezone(timezone.utc).strftime(ISO_FMT)
+    
+    # Free/busy is enough to answer; only fetch events to name the conflicts
+    busy = await calendar_service.query_freebusy(time_min, time_max)
+    
+    is_available = len(busy) == 0
+    conflicts = []
+    if busy:
         events = await calendar_service.get_google_events(
-            start_datetime.isoformat() + 'Z',
-            end_datetime.isoformat() + 'Z'
+            time_min,
+            time_max,
+            fields="items(summary,start,end)"
         )
-        
-        is_available = len(events) == 0
-        conflicts = [event.get('summary', 'Untitled') for event in events] if events else []
-        
-        return {
-            "available": is_available,
-            "conflicts": conflicts,
-            "requested_slot": {
-                "date": date,
-                "start_time": start_time,
-                "duration_minutes": duration
-            }
+        conflicts = [event.get('summary', 'Untitled') for event in events]
+    
+    return {
+        "available": is_available,
+        "conflicts": conflicts,
+        "requested_slot": {
+            "date": date,
+            "start_time": start_time,
+            "duration_minutes": duration
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    }
 
 @app.get("/airtable/{table_name}")
 async def get_airtable_records(table_name: str, filter_formula: str = None):
-    """Get records from Airtable"""
-    try:
-        records = await calendar_service.get_airtable_records(table_name, filter_formula)
-        return {"records": records}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    """Stream every record from an Airtable table as newline-delimited JSON"""
+    records = calendar_service.iter_airtable_records(table_name, filter_formula)
+    # Fetch the first page before committing to a 200 so an upstream failure
+    # there becomes a 502; a failure on a later page aborts the stream
+    first = await anext(records, None)
+    return StreamingResponse(_ndjson(first, records), media_type="application/x-ndjson")
 
 @app.post("/airtable/{table_name}")
 async def create_airtable_record(table_name: str, fields: Dict[str, Any]):
     """Create a new Airtable record"""
-    try:
-        result = await calendar_service.create_airtable_record(table_name, fields)
-        if result:
-            return {"success": True, "record": result}
-        else:
-            raise HTTPException(status_code=400, detail="Failed to create record")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    result = await calendar_service.create_airtable_record(table_name, fields)
+    if result:
+        return {"success": True, "record": result}
+    else:
+        raise HTTPException(status_code=400, detail="Failed to create record")
+
+@app.post("/airtable/{table_name}/batch")
+async def create_airtable_records(
+    table_name: str,
+    records: Annotated[List[Dict[str, Any]], Field(min_length=1)]
+):
+    """Create several Airtable records in batched requests"""
+    created, failed = await calendar_service.create_airtable_records(table_name, records)
+    content = {
+        "success": not failed,
+        "records": created,
+        "count": len(created),
+        "failed": failed
+    }
+    if not created:
+        return OrjsonResponse(status_code=502, content=content)
+    if failed:
+        # Some chunks were created and some were not
+        return OrjsonResponse(status_code=207, content=content)
+    return content
 
 @app.post("/tasks")
-async def create_task(task_data: Dict[str, Any]):
+async def create_task(task_data: TaskIn):
     """Create a new task in Airtable"""
-    try:
-        fields = {
-            "Name": task_data.get("name"),
-            "Status": task_data.get("status", "To Do"),
-            "Priority": task_data.get("priority", "Medium"),
-            "Due Date": task_data.get("due_date"),
-            "Notes": task_data.get("notes", "")
-        }
-        
-        # Remove None values
-        fields = {k: v for k, v in fields.items() if v is not None}
-        
-        result = await calendar_service.create_airtable_record("Tasks", fields)
-        if result:
-            return {"success": True, "task": result}
-        else:
-            raise HTTPException(status_code=400, detail="Failed to create task")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    fields = {
+        "Name": task_data.name,
+        "Status": task_data.status,
+        "Priority": task_data.priority,
+        "Due Date": task_data.due_date,
+        "Notes": task_data.notes
+    }
+    
+    # Remove None values
+    fields = {k: v for k, v in fields.items() if v is not None}
+    
+    result = await calendar_service.create_airtable_record("Tasks", fields)
+    if result:
+        return {"success": True, "task": result}
+    else:
+        raise HTTPException(status_code=400, detail="Failed to create task")
 
 @app.post("/contacts/search")
-async def search_contacts(search_data: Dict[str, Any]):
+async def search_contacts(search_data: ContactSearchIn):
     """Search for contacts in Airtable"""
-    try:
-        search_term = search_data.get("search_term", "").lower()
-        records = await calendar_service.get_airtable_records("Contacts")
-        
-        matching_contacts = []
-        for record in records:
-            fields = record.get("fields", {})
-            name = fields.get("Name", "").lower()
-            email = fields.get("Email", "").lower()
-            
-            if search_term in name or search_term in email:
-                matching_contacts.append({
-                    "id": record.get("id"),
-                    "name": fields.get("Name"),
-                    "email": fields.get("Email"),
-                    "phone": fields.get("Phone")
-                })
-        
-        return {"contacts": matching_contacts, "count": len(matching_contacts)}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    search_term = search_data.search_term
+    
+    # Let Airtable do the case-insensitive match instead of scanning every row here
+    filter_formula = None
+    if search_term:
+        term = airtable_string(search_term)
+        filter_formula = (
+            f"OR(FIND(LOWER({term}), LOWER({{Name}})), "
+            f"FIND(LOWER({term}), LOWER({{Email}})))"
+        )
+    
+    records = await calendar_service.get_airtable_records(
+        "Contacts",
+        filter_formula,
+        max_records=CONTACT_SEARCH_LIMIT,
+        page_size=CONTACT_SEARCH_LIMIT
+    )
+    
+    matching_contacts = [
+        {
+            "id": record.get("id"),
+            "name": record.get("fields", {}).get("Name"),
+            "email": record.get("fields", {}).get("Email"),
+            "phone": record.get("fields", {}).get("Phone")
+        }
+        for record in records
+    ]
+    
+    return {"contacts": matching_contacts, "count": len(matching_contacts)}
 
 @app.post("/reminders")
-async def create_reminder(reminder_data: Dict[str, Any]):
+async def create_reminder(reminder_data: ReminderIn):
     """Create a reminder (calendar event + Airtable task)"""
-    try:
-        from datetime import datetime, timedelta
-        
-        title = reminder_data.get("title")
-        reminder_datetime = reminder_data.get("datetime")
-        notes = reminder_data.get("notes", "")
-        
-        # Create calendar event
-        event_data = {
-            "summary": f"Reminder: {title}",
-            "start": {
-                "dateTime": reminder_datetime,
-                "timeZone": "America/New_York"
-            },
-            "end": {
-                "dateTime": (datetime.fromisoformat(reminder_datetime.replace('Z', '')) + timedelta(minutes=15)).isoformat() + 'Z',
-                "timeZone": "America/New_York"
-            },
-            "description": notes
-        }
-        
-        # Create Airtable task
-        task_fields = {
-            "Name": f"Reminder: {title}",
-            "Status": "Pending", 
-            "Due Date": reminder_datetime.split('T')[0],
-            "Notes": notes
-        }
-        
-        calendar_result = await calendar_service.create_google_event(event_data)
-        airtable_result = await calendar_service.create_airtable_record("Tasks", task_fields)
-        
-        return {
-            "success": True,
-            "calendar_created": calendar_result is not None,
-            "airtable_created": airtable_result is not None,
-            "calendar_event": calendar_result,
-            "airtable_task": airtable_result
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    title = reminder_data.title
+    reminder_datetime = reminder_data.datetime
+    notes = reminder_data.notes
+    
+    # Create calendar event
+    event_data = {
+        "summary": f"Reminder: {title}",
+        "start": {"dateTime": reminder_datetime.isoformat(), **_TZ},
+        "end": {"dateTime": (reminder_datetime + _duration(15)).isoformat(), **_TZ},
+        "description": notes
+    }
+    
+    # Create Airtable task
+    task_fields = {
+        "Name": f"Reminder: {title}",
+        "Status": "Pending", 
+        "Due Date": reminder_datetime.date().isoformat(),
+        "Notes": notes
+    }
+    
+    # The two writes are independent, so run them concurrently
+    calendar_result, airtable_result = await asyncio.gather(
+        calendar_service.create_google_event(event_data),
+        calendar_service.create_airtable_record("Tasks", task_fields),
+        return_exceptions=True
+    )
+    if isinstance(calendar_result, Exception):
+        logger.warning("Reminder calendar event failed: %r", calendar_result)
+        calendar_result = None
+    if isinstance(airtable_result, Exception):
+        logger.warning("Reminder Airtable task failed: %r", airtable_result)
+        airtable_result = None
+    
+    calendar_created = calendar_result is not None
+    airtable_created = airtable_result is not None
+    
+    return {
+        "success": calendar_created and airtable_created,
+        "calendar_created": calendar_created,
+        "airtable_created": airtable_created,
+        "calendar_event": calendar_result,
+        "airtable_task": airtable_result
+    }
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))